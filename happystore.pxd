@@ -0,0 +1,26 @@
+# Copyright 2024 Joseph P McAnulty. All rights reserved.
+# augmenting declarations used when happystore.py is compiled with cython
+# in "pure python" mode (see setup.py). not needed to use the module.
+
+cdef class _SqlLiteHappyStore:
+    cdef object _serializer
+
+    cdef object _txn_rlock
+    cdef bint _is_already_in_txn
+    cdef int _txn_nesting_level
+    cdef object _txn_owner
+    cdef object _write_txn
+    cdef object _read_txn
+
+    cdef object _sqlite_connection
+    cdef bint _sqlite_connection_is_already_closed
+
+    cdef object _get_cursor
+    cdef object _has_cursor
+    cdef object _set_cursor
+    cdef object _delete_cursor
+
+
+cdef class _Txn:
+    cdef _SqlLiteHappyStore _store
+    cdef object _begin_statement
@@ -167,12 +167,19 @@ below for some more information.
 
 
 import abc as _abc
-import contextlib as _contextlib
+import functools as _functools
 import io as _io
+import json as _json
 import pickle as _pickle
+import re as _re
 import threading as _threading
 import sqlite3 as _sqlite3
 
+try:
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
+
 
 class AbortionError(Exception):
     """An exception to raise inside a transaction to abort
@@ -222,6 +229,8 @@ class Serializer(_abc.ABC):
     ...
 
     """
+    __slots__ = ()
+
     @_abc.abstractmethod
     def serialize(self, value):
         """Serialize an object
@@ -259,16 +268,24 @@ class PickleSerializer(Serializer):
     """A serializer implementation that uses the python pickle
     module to serialize and deserialize values. Custom
     Pickler and Unpickler classes can be passed to the constructor
-    to customize behavior further.
+    to customize behavior further. By default values are pickled
+    with pickle.HIGHEST_PROTOCOL (5 from python 3.8 on), which is the
+    fastest and most compact on bytes and buffer heavy values. A custom
+    pickler_factory is called with just the file, and so picks its own
+    protocol, unless protocol is passed explicitly.
 
     """
+    __slots__ = ('pickler_factory', 'unpickler_factory', 'protocol', '__weakref__')
+
     def __init__(
         self,
         pickler_factory=_pickle.Pickler,
-        unpickler_factory=_pickle.Unpickler
+        unpickler_factory=_pickle.Unpickler,
+        protocol=None
     ):
         self.pickler_factory = pickler_factory
         self.unpickler_factory = unpickler_factory
+        self.protocol = protocol
 
     def serialize(self, value):
         """Serialize an object with pickler_factory
@@ -284,8 +301,21 @@ class PickleSerializer(Serializer):
         """
 
         try:
+            # dumps does the whole thing in one C call, only custom
+            # picklers need to go through a BytesIO
+            if self.pickler_factory is _pickle.Pickler:
+                return _pickle.dumps(
+                    value,
+                    protocol=(
+                        _pickle.HIGHEST_PROTOCOL if self.protocol is None
+                        else self.protocol
+                    )
+                )
             f = _io.BytesIO()
-            p = self.pickler_factory(f)
+            if self.protocol is None:
+                p = self.pickler_factory(f)
+            else:
+                p = self.pickler_factory(f, protocol=self.protocol)
             p.dump(value)
             return f.getvalue()
         except Exception:
@@ -305,6 +335,8 @@ class PickleSerializer(Serializer):
 
         """
         try:
+            if self.unpickler_factory is _pickle.Unpickler:
+                return _pickle.loads(bytess)
             f = _io.BytesIO(bytess)
             return self.unpickler_factory(f).load()
         except Exception:
@@ -314,7 +346,13 @@ class JsonSerializer(Serializer):
     """A serializer implementation that uses the python json module
     to serialize and deserialize values. expects utf-8 encoded json.
 
+    If orjson is installed it is used instead for values it encodes
+    exactly like the json module does. everything else still goes
+    through the json module, so what can be stored, and how it reads
+    back, doesn't depend on orjson being installed.
+
     """
+    __slots__ = ('__weakref__',)
 
     def serialize(self, value):
         """Serialize an object to utf-8 json
@@ -329,8 +367,20 @@ class JsonSerializer(Serializer):
             - SerializationError: if the value couldn't be serialized
 
         """
+        if _orjson is not None and _is_plain_json(value):
+            try:
+                return _orjson.dumps(
+                    value,
+                    option=(
+                        _orjson.OPT_PASSTHROUGH_DATETIME
+                        | _orjson.OPT_PASSTHROUGH_DATACLASS
+                        | _orjson.OPT_PASSTHROUGH_SUBCLASS
+                    )
+                )
+            except Exception:  # e.g. lone surrogates in a str
+                pass
         try:
-            return json.dumps(value).encode('utf-8')
+            return _json.dumps(value).encode('utf-8')
         except Exception:
             raise SerializationError('couldn\'t serialize value')
 
@@ -347,8 +397,14 @@ class JsonSerializer(Serializer):
             - DeserializationError: if the value couldn't be deserialized
 
         """
+        if _orjson is not None:
+            try:
+                if not _LONG_DIGIT_RUN.search(bytess):
+                    return _orjson.loads(bytess)
+            except Exception:
+                pass
         try:
-            return json.loads(bytes.decode('utf-8'))
+            return _json.loads(bytess.decode('utf-8'))
         except Exception:
             raise DeserializationError('couldn\'t deserialize value')
 
@@ -360,6 +416,7 @@ class RawSerializer(Serializer):
        the same.
 
     """
+    __slots__ = ('__weakref__',)
 
     def serialize(self, value):
         """Serialize pure bytes
@@ -392,16 +449,18 @@ class RawSerializer(Serializer):
             - DeserializationError: if the value couldn't be deserialized
 
         """
-        if type(bytes) is bytes:
-            return value
+        if type(bytess) is bytes:
+            return bytess
         else:
-            raise SerializationError('couldn\'t serialize value')
+            raise DeserializationError('couldn\'t deserialize value')
 
 
 class HappyStore:
     """
     The class for connection to a HappyStore database.
     """
+    __slots__ = ('_happy_store_impl', '__weakref__')
+
     def __init__(self, database, serializer, timeout=None):
         """make and connect to a new HappyStore, or connect to an existing one
 
@@ -446,7 +505,7 @@ class HappyStore:
             - DeserializationError: if the value couldn't be deserialized
         """
         if type(key) is not str:
-            raise TypeError('key must be a str, not %s' % type(key))
+            _raise_key_type_error(key)
         return self._happy_store_impl.get(key)
 
     def bulk_get(self, keys):
@@ -458,9 +517,6 @@ class HappyStore:
         Returns:
             - a list of values and/or LookupErrors
         """
-        for key in keys:
-            if type(key) is not str:
-                raise TypeError('key must be a str, not %s' % type(key))
         return self._happy_store_impl.bulk_get(keys)
 
     def has(self, key):
@@ -473,7 +529,7 @@ class HappyStore:
             - bool: The value of the key value pair
         """
         if type(key) is not str:
-            raise TypeError('key must be a str, not %s' % type(key))
+            _raise_key_type_error(key)
         return self._happy_store_impl.has(key)
 
     def set(self, key, value):
@@ -487,7 +543,7 @@ class HappyStore:
             - SerializationError: if the value couldn't be serialized
         """
         if type(key) is not str:
-            raise TypeError('key must be a str, not %s' % type(key))
+            _raise_key_type_error(key)
         return self._happy_store_impl.set(key, value)
 
     def bulk_set(self, key_value_pairs):
@@ -499,9 +555,6 @@ class HappyStore:
         Raises:
             - SerializationError: if the value couldn't be serialized
         """
-        for key, val in key_value_pairs:
-            if type(key) is not str:
-                raise TypeError('key must be a str, not %s' % type(key))
         return self._happy_store_impl.bulk_set(key_value_pairs)
 
     def delete(self, key):
@@ -514,7 +567,7 @@ class HappyStore:
             - bool: True if the key found and deleted, False if it didn't exist
         """
         if type(key) is not str:
-            raise TypeError('key must be a str, not %s' % type(key))
+            _raise_key_type_error(key)
         return self._happy_store_impl.delete(key)
 
     def bulk_delete(self, keys):
@@ -526,9 +579,6 @@ class HappyStore:
         Returns:
             - a list of boolean values for each key removed
         """
-        for key in keys:
-            if type(key) is not str:
-                raise TypeError('key must be a str, not %s' % type(key))
         return self._happy_store_impl.bulk_delete(keys)
 
     def query(self, keyprefix=None, start=None, end=None, limit=None, reverse=False):
@@ -551,17 +601,17 @@ class HappyStore:
                 - list: a list of tuples containing the found key value pairs   
         """
         if type(keyprefix) not in (str, type(None)):
-            raise TypeError('keyprefix must be a str, not %s' % type(key))
+            raise TypeError('keyprefix must be a str, not %s' % type(keyprefix))
         if type(start) not in (str, type(None)):
-            raise TypeError('start must be a str, not %s' % type(key))
+            raise TypeError('start must be a str, not %s' % type(start))
         if type(end) not in (str, type(None)):
-            raise TypeError('end must be a str, not %s' % type(key))
+            raise TypeError('end must be a str, not %s' % type(end))
         # either only keyprefix of min/max are allowed
         if keyprefix is not None and (start is not None or end is not None):
             raise RuntimeError('only supply keyprefix, or start and end')
         return self._happy_store_impl.query(keyprefix, start, end, limit, reverse)
 
-    def scan(self, pagesize=100):
+    def scan(self, pagesize=1000):
         """iterate through key-value pairs in the happystore, one page
            at a time. pagesize can be adjusted to fine tune the performance.
            larger page sizes consume more memory but perform less io.
@@ -573,7 +623,9 @@ class HappyStore:
                 - an iterator of of key-value pairs
         """
         if type(pagesize) is not int:
-            raise TypeError('pagesize must be int, not %s' % type(key))
+            raise TypeError('pagesize must be int, not %s' % type(pagesize))
+        if pagesize < 1:
+            raise ValueError('pagesize must be at least 1')
         return self._happy_store_impl.scan(pagesize)
 
     def transaction(self):
@@ -600,7 +652,95 @@ class HappyStore:
         return self._happy_store_impl.transaction()
 
 
+_SQL_GET = """
+    SELECT value
+      FROM database
+     WHERE key = ?;
+"""
+
+_SQL_HAS = """
+    SELECT 1
+      FROM database
+     WHERE key = ?
+     LIMIT 1;
+"""
+
+_SQL_SET = """
+    REPLACE INTO database
+    VALUES (?, ?)
+"""
+
+_SQL_DELETE = """
+    DELETE FROM database
+     WHERE key = ?;
+"""
+
+# for the bulk operations, the keys are bound as a single json array so the
+# statement text doesn't depend on the number of keys
+_SQL_BULK_GET = """
+    SELECT key, value
+      FROM database
+     WHERE key IN (SELECT value FROM json_each(?));
+"""
+
+_SQL_BULK_DELETE = """
+    DELETE FROM database
+     WHERE key IN (SELECT value FROM json_each(?))
+ RETURNING key;
+"""
+
+# DELETE ... RETURNING is only available from sqlite 3.35 on
+_SQLITE_SUPPORTS_RETURNING = _sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+def _sqlite_supports_json():
+    # the json functions are only built in from sqlite 3.38 on; before that
+    # they're a compile time option
+    conn = _sqlite3.connect(':memory:')
+    try:
+        conn.execute("SELECT json('[]');")
+    except _sqlite3.OperationalError:
+        return False
+    finally:
+        conn.close()
+    return True
+
+
+_SQLITE_SUPPORTS_JSON = _sqlite_supports_json()
+
+_SQL_SCAN_FIRST_PAGE = """
+    SELECT key, value
+      FROM database
+  ORDER BY key
+     LIMIT ?;
+"""
+
+_SQL_SCAN_NEXT_PAGE = """
+    SELECT key, value
+      FROM database
+     WHERE key > ?
+  ORDER BY key
+     LIMIT ?;
+"""
+
+
 class _SqlLiteHappyStore:
+    __slots__ = (
+        '_serializer',
+        '_txn_rlock',
+        '_is_already_in_txn',
+        '_txn_nesting_level',
+        '_txn_owner',
+        '_write_txn',
+        '_read_txn',
+        '_sqlite_connection',
+        '_sqlite_connection_is_already_closed',
+        '_get_cursor',
+        '_has_cursor',
+        '_set_cursor',
+        '_delete_cursor',
+    )
+
     def __init__(self, database, serializer, timeout):
         # serializer registration
         self._serializer = serializer
@@ -609,15 +749,39 @@ class _SqlLiteHappyStore:
         self._txn_rlock = _threading.RLock()
         self._is_already_in_txn = False
         self._txn_nesting_level = 0
-
-        # interface into main db
+        self._txn_owner = None  # thread ident of the thread in the open txn
+        # explicit transactions take the write lock up front with BEGIN
+        # IMMEDIATE, since we can't know whether the block will write. a
+        # deferred transaction only takes a read lock (a read snapshot in WAL
+        # mode), so read only operations in other processes don't queue up
+        # behind each other waiting for the write lock. read transactions
+        # only ever wrap a single internal read, never user code or writes
+        self._write_txn = _Txn(self, 'BEGIN IMMEDIATE TRANSACTION;')
+        self._read_txn = _Txn(self, 'BEGIN DEFERRED TRANSACTION;')
+
+        # interface into main db. isolation_level=None puts the sqlite3 module
+        # in autocommit mode, so it never issues its own implicit BEGIN/COMMIT;
+        # transaction boundaries are managed explicitly in transaction()
         self._sqlite_connection = _sqlite3.connect(
             database,
             check_same_thread=False,
-            isolation_level='EXCLUSIVE',
-            timeout=(timeout or 5.0)
+            isolation_level=None,
+            timeout=(timeout or 5.0),
+            cached_statements=1024
         )
         self._sqlite_connection_is_already_closed = False
+        # WAL journaling + synchronous=NORMAL avoids an fsync of a rollback
+        # journal on every commit, and mmap speeds up reads on disk backed stores
+        self._sqlite_connection.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            PRAGMA temp_store = MEMORY;
+            PRAGMA cache_size = -65536;
+            PRAGMA mmap_size = 268435456;
+        """)
+        # a plain rowid table on purpose: values are serialized objects that
+        # are often bigger than the ~1/20 of a page where WITHOUT ROWID stops
+        # paying off, and past that it is slower and the file grows
         self._sqlite_connection.executescript("""
             CREATE TABLE IF NOT EXISTS database (
                 key              TEXT PRIMARY KEY,
@@ -625,6 +789,13 @@ class _SqlLiteHappyStore:
             )
         """)
 
+        # cursors reused by the hot single key operations. they're only
+        # ever used while holding _txn_rlock, so sharing them is safe
+        self._get_cursor = self._sqlite_connection.cursor()
+        self._has_cursor = self._sqlite_connection.cursor()
+        self._set_cursor = self._sqlite_connection.cursor()
+        self._delete_cursor = self._sqlite_connection.cursor()
+
     def close(self):
         with self._txn_rlock:
             if not self._sqlite_connection_is_already_closed:
@@ -634,31 +805,23 @@ class _SqlLiteHappyStore:
     def get(self, key):
         value_bytes = self._ensure_execution_in_txn(
             self._get_impl,
-            [key]
+            (key,),
+            read_only=True
         )
         desrialized_value = self._serializer.deserialize(value_bytes)
         return desrialized_value
 
     def _get_impl(self, key):
-        curs = self._sqlite_connection.execute(
-            """
-            SELECT value
-              FROM database
-             WHERE key = ?;
-            """,
-            [key]
-        )
-        results = curs.fetchall()
-        if len(results) != 0:
-            value_bytes = results[0][0]
-            return value_bytes
-        else:
+        row = self._get_cursor.execute(_SQL_GET, (key,)).fetchone()
+        if row is None:
             raise LookupError(key)
+        return row[0]
 
     def bulk_get(self, keys):
         values_bytes = self._ensure_execution_in_txn(
             self._bulk_get_impl,
-            [keys]
+            (keys,),
+            read_only=True
         )  # Note theat 'values_bytes' list may also contain LookupError for items that don't exist
         deserialized_values = [
             self._serializer.deserialize(value_bytes) 
@@ -669,251 +832,309 @@ class _SqlLiteHappyStore:
         return deserialized_values
     
     def _bulk_get_impl(self, keys):
-        curs = self._sqlite_connection.execute(
-            f"""
-            SELECT key, value
-              FROM database
-             WHERE key IN ({','.join(['?']*len(keys))});
-            """,
-            keys
-        )
-        results = curs.fetchall()
-        found_kv_pairs = {result[0]: result[1] for result in results}
-
+        keys_json = _keys_as_json(keys)
+        if keys_json is not None:
+            curs = self._sqlite_connection.execute(
+                _SQL_BULK_GET,
+                (keys_json,)
+            )
+            found_kv_pairs = {result[0]: result[1] for result in curs}
+        else:
+            # one bound lookup per key, see _keys_as_json
+            found_kv_pairs = {}
+            for key in keys:
+                if type(key) is str:
+                    row = self._get_cursor.execute(_SQL_GET, (key,)).fetchone()
+                    if row is not None:
+                        found_kv_pairs[key] = row[0]
+
+        # keys are type checked here, in the pass that assembles the results,
+        # rather than in a separate pass up front
         return [
-            found_kv_pairs[key] if key in found_kv_pairs else LookupError(key)
+            (found_kv_pairs[key] if key in found_kv_pairs else LookupError(key))
+            if type(key) is str else _raise_key_type_error(key)
             for key in keys
         ]
 
     def has(self, key):
         return self._ensure_execution_in_txn(
             self._has_impl,
-            [key]
+            (key,),
+            read_only=True
         )
 
     def _has_impl(self, key):
-        curs = self._sqlite_connection.execute(
-            """
-            SELECT 1
-              FROM database
-             WHERE key = ?
-             LIMIT 1;
-            """,
-            [key]
-        )
-        results = curs.fetchall()
-        if len(results) != 0:
-            return True
-        else:
-            return False
+        return self._has_cursor.execute(_SQL_HAS, (key,)).fetchone() is not None
 
     def set(self, key, value):
         value_bytes = self._serializer.serialize(value)
         return self._ensure_execution_in_txn(
             self._set_impl,
-            [key, value_bytes]
+            (key, value_bytes)
         )
 
     def _set_impl(self, key, value):
-        self._sqlite_connection.execute(
-            """
-            REPLACE INTO database
-            VALUES (?, ?)
-            """,
-            [key, value]
-        )
+        self._set_cursor.execute(_SQL_SET, (key, value))
 
     def bulk_set(self, key_value_pairs):
-        key_serialized_value_pairs = [
-            (k, self._serializer.serialize(v))
-            for k, v in key_value_pairs
-        ]
-        return self._ensure_execution_in_txn(
-            self._bulk_set_impl,
-            [key_serialized_value_pairs]
-        )
-
-    def _bulk_set_impl(self, key_serialized_value_pairs):
-        self._sqlite_connection.execute(
-            f"""
-            REPLACE INTO database
-            VALUES {','.join(['(?, ?)']*len(key_serialized_value_pairs))}
-            """,
-            _flatten(key_serialized_value_pairs)
+        # keys are checked and values serialized as the batch is written, so
+        # always run in a (possibly nested) transaction of our own; a bad key
+        # or value part way through then rolls back just this batch, even
+        # inside an enclosing transaction
+        with self.transaction():
+            self._bulk_set_impl(key_value_pairs)
+
+    def _bulk_set_impl(self, key_value_pairs):
+        # keys are type checked and values serialized one at a time as
+        # executemany consumes them, so the whole batch of serialized values
+        # never exists at once and there's no separate validation pass
+        self._sqlite_connection.executemany(
+            _SQL_SET,
+            (
+                (
+                    k if type(k) is str else _raise_key_type_error(k),
+                    self._serializer.serialize(v)
+                )
+                for k, v in key_value_pairs
+            )
         )
 
     def delete(self, key):
         return self._ensure_execution_in_txn(
             self._delete_impl,
-            [key]
+            (key,)
         )
 
     def _delete_impl(self, key):
-        curs = self._sqlite_connection.execute(
-            """
-            DELETE FROM database
-             WHERE key = ?;
-            """,
-            [key]
-        )
+        curs = self._delete_cursor.execute(_SQL_DELETE, (key,))
         return curs.rowcount > 0
 
     def bulk_delete(self, keys):
-        return self._ensure_execution_in_txn(
-            self._bulk_delete_impl,
-            [keys]
-        )
+        # see bulk_set
+        with self.transaction():
+            return self._bulk_delete_impl(keys)
 
     def _bulk_delete_impl(self, keys):
-        curs = self._sqlite_connection.execute(
-            f"""
-            SELECT key
-              FROM database
-             WHERE key IN ({','.join(['?']*len(keys))});
-            """,
-            keys
-        )
-        results = curs.fetchall()
-        found_keys = {result[0] for result in results}
-
-        curs = self._sqlite_connection.execute(
-            f"""
-            DELETE FROM database
-             WHERE key IN ({','.join(['?']*len(keys))});
-            """,
-            keys
-        )
+        keys_json = _keys_as_json(keys) if _SQLITE_SUPPORTS_RETURNING else None
+        if keys_json is not None:
+            # deletes and reports which keys existed in a single pass
+            curs = self._sqlite_connection.execute(
+                _SQL_BULK_DELETE,
+                (keys_json,)
+            )
+            found_keys = {result[0] for result in curs}
+        else:
+            found_keys = self._bulk_delete_without_returning_impl(keys)
 
+        # keys are type checked in the pass that assembles the results. we're
+        # always in bulk_delete's own transaction here, so raising rolls back
+        # the delete
         return [
-            (key in found_keys) 
+            (key in found_keys) if type(key) is str else _raise_key_type_error(key)
             for key in keys
         ]
 
+    def _bulk_delete_without_returning_impl(self, keys):
+        # one bound DELETE per key, so which keys existed is decided by the
+        # very statement that removes them
+        return {
+            key for key in keys
+            if type(key) is str and self._delete_impl(key)
+        }
+
     def query(self, keyprefix, start, end, limit, reverse):
-        kv_pairs_with_bytes_values = self._ensure_execution_in_txn(
+        return self._ensure_execution_in_txn(
             self._query_impl,
-            [keyprefix, start, end, limit, reverse]
+            (keyprefix, start, end, limit, reverse),
+            read_only=True
         )
-        kv_pairs = [
-            (k, self._serializer.deserialize(v))
-            for k, v in kv_pairs_with_bytes_values
-        ]
-        return kv_pairs
 
     def _query_impl(self, keyprefix, start, end, limit, reverse):
         if keyprefix is not None:
-            sql = f"""
-                SELECT key, value
-                FROM database
-                WHERE key LIKE ?
-             ORDER BY key
-             {'' if limit is None else 'LIMIT ?'};
-            """
-            params = [keyprefix + '%'] if limit is None else [keyprefix + '%', limit]
+            where = 'key LIKE ?'
+            params = [keyprefix + '%']
         elif start is not None and end is not None:
-            sql = f"""
-                SELECT key, value
-                FROM database
-                WHERE key >= ? AND key <= ?
-             ORDER BY key {'ASC' if not reverse else 'DESC'}
-             {'' if limit is None else 'LIMIT ?'};
-            """
-            params = [start, end] if limit is None else [start, end, limit]
+            where = 'key >= ? AND key <= ?'
+            params = [start, end]
         elif start is not None and end is None:
-            sql = f"""
-                SELECT key, value
-                FROM database
-                WHERE key >= ?
-             ORDER BY key {'ASC' if not reverse else 'DESC'}
-             {'' if limit is None else 'LIMIT ?'};
-            """
-            params = [start] if limit is None else [start, limit]
+            where = 'key >= ?'
+            params = [start]
         elif start is None and end is not None:
-            sql = f"""
-                SELECT key, value
-                FROM database
-                WHERE key <= ?
-             ORDER BY key {'ASC' if not reverse else 'DESC'}
-             {'' if limit is None else 'LIMIT ?'};
-            """
-            params = [end] if limit is None else [end, limit]
-
+            where = 'key <= ?'
+            params = [end]
+        if limit is not None:
+            params.append(limit)
+        sql = _query_sql(where, bool(reverse), limit is not None)
+
+        # deserialize straight off the cursor rather than building an
+        # intermediate list of (key, bytes) rows first
         curs = self._sqlite_connection.execute(sql, params)
-        return curs.fetchall()
-
-    def scan(self, pagesize=100):
-        next_key = ''  # the 'smallest' string to start
+        return [(k, self._serializer.deserialize(v)) for k, v in curs]
+
+    def scan(self, pagesize):
+        # keyset pagination: every page is fetched in its own short transaction
+        # and picks up right after the last key of the previous page. holding
+        # one cursor open for the whole scan would instead tie up the shared
+        # connection for as long as the caller takes to consume the iterator
+        last_key = None
         while True:
-            sql = """
-                SELECT key, value
-                  FROM database
-                 WHERE key >= ?
-              ORDER BY key
-                 LIMIT ?
-            """
-            params = [next_key, pagesize + 1]
-            with self.transaction():
-                curs = self._sqlite_connection.execute(sql, params)
+            with self._read_txn:
+                if last_key is None:
+                    curs = self._sqlite_connection.execute(
+                        _SQL_SCAN_FIRST_PAGE,
+                        (pagesize,)
+                    )
+                else:
+                    curs = self._sqlite_connection.execute(
+                        _SQL_SCAN_NEXT_PAGE,
+                        (last_key, pagesize)
+                    )
                 page = curs.fetchall()
-            if len(page) < pagesize + 1:   # we're at the end
-                page = [
-                    (k, self._serializer.deserialize(v))
-                    for k, v in page
-                ]
-                for item in page:
-                    yield item
+            # values are deserialized lazily, as the rows are consumed
+            for k, v in page:
+                yield (k, self._serializer.deserialize(v))
+            if len(page) < pagesize:   # we're at the end
                 break
-            next_key = page[-1][0]
-            page.pop()
-            page = [
-                (k, self._serializer.deserialize(v))
-                for k, v in page
-            ]
-            for item in page:
-                yield item
-
-    @_contextlib.contextmanager
+            last_key = page[-1][0]
+
     def transaction(self):
-        with self._txn_rlock:
-            try:
-                if self._is_already_in_txn:
-                    self._txn_nesting_level += 1
-                    self._sqlite_connection.execute('SAVEPOINT txn;')
-                else:
-                    self._is_already_in_txn = True
-                    self._sqlite_connection.execute('BEGIN EXCLUSIVE TRANSACTION;')
-                yield
-            except AbortionError:
-                if self._txn_nesting_level > 0:
-                    self._sqlite_connection.execute('ROLLBACK TO txn;')
-                else:
-                    self._sqlite_connection.execute('ROLLBACK;')
-            except Exception:
-                if self._txn_nesting_level > 0:
-                    self._sqlite_connection.execute('ROLLBACK TO txn;')
-                else:
-                    self._sqlite_connection.execute('ROLLBACK;')
-                raise
+        return self._write_txn
+
+    def _ensure_execution_in_txn(self, f, args=(), read_only=False):
+        # fast path: the calling thread is already inside the open transaction,
+        # so it holds _txn_rlock and can run f directly. reading these without
+        # the lock is fine; they only ever equal this thread's ident while this
+        # thread is the one in the transaction, otherwise we take the slow path
+        if self._is_already_in_txn and self._txn_owner == _threading.get_ident():
+            return f(*args)
+        with (self._read_txn if read_only else self._write_txn):
+            return f(*args)
+
+
+class _Txn:
+    """context manager for (possibly nested) transactions on a
+    _SqlLiteHappyStore. All of the transaction state lives on the store and
+    _txn_rlock makes entering re-entrant per thread, so each store keeps one
+    reusable instance per kind of transaction rather than making one per use.
+    """
+    __slots__ = ('_store', '_begin_statement')
+
+    def __init__(self, store, begin_statement):
+        self._store = store
+        self._begin_statement = begin_statement
+
+    def __enter__(self):
+        store = self._store
+        store._txn_rlock.acquire()
+        try:
+            if store._is_already_in_txn:
+                store._txn_nesting_level += 1
+                store._sqlite_connection.execute('SAVEPOINT txn;')
             else:
-                if self._txn_nesting_level > 0:
-                    self._sqlite_connection.execute('RELEASE SAVEPOINT txn;')
-                else:
-                    self._sqlite_connection.execute('COMMIT;')
-            finally:
-                if self._txn_nesting_level == 0:
-                    self._is_already_in_txn = False
+                store._is_already_in_txn = True
+                store._txn_owner = _threading.get_ident()
+                store._sqlite_connection.execute(self._begin_statement)
+        except BaseException:
+            # nothing was started, so just undo the bookkeeping
+            self._leave()
+            raise
+        return None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        store = self._store
+        try:
+            is_nested = store._txn_nesting_level > 0
+            if exc_type is None:
+                if is_nested:
+                    store._sqlite_connection.execute('RELEASE SAVEPOINT txn;')
                 else:
-                    self._txn_nesting_level -= 1
+                    store._sqlite_connection.execute('COMMIT;')
+                return False
+            if is_nested:
+                # ROLLBACK TO leaves the savepoint on the stack, so release it
+                # too or an enclosing rollback would only go back to it
+                store._sqlite_connection.execute('ROLLBACK TO txn;')
+                store._sqlite_connection.execute('RELEASE SAVEPOINT txn;')
+            else:
+                store._sqlite_connection.execute('ROLLBACK;')
+            # an AbortionError is swallowed, anything else is re-raised
+            return issubclass(exc_type, AbortionError)
+        finally:
+            self._leave()
+
+    def _leave(self):
+        store = self._store
+        if store._txn_nesting_level == 0:
+            store._is_already_in_txn = False
+            store._txn_owner = None
+        else:
+            store._txn_nesting_level -= 1
+        store._txn_rlock.release()
+
+
+@_functools.lru_cache(maxsize=None)
+def _query_sql(where, reverse, has_limit):
+    # there are only a handful of distinct query shapes, so build the text of
+    # each one once rather than on every call
+    return f"""
+        SELECT key, value
+          FROM database
+         WHERE {where}
+      ORDER BY key {'DESC' if reverse else 'ASC'}
+         {'LIMIT ?' if has_limit else ''};
+    """
 
 
-    def _ensure_execution_in_txn(self, f, args=[], kwargs={}):
-        with self._txn_rlock:
-            if self._is_already_in_txn:
-                return f(*args, **kwargs)
-            else:
-                with self.transaction():
-                    return f(*args, **kwargs)
+# orjson reads ints that don't fit in 64 bits back as floats. those take at
+# least 19 digits, so payloads with such a run are left to the json module
+_LONG_DIGIT_RUN = _re.compile(rb'[0-9]{19}')
+
+
+def _is_plain_json(value, depth=0):
+    # whether value is made only of exact json types that orjson encodes the
+    # same way as the json module. orjson alone would also encode UUIDs,
+    # enums, dataclasses, dates and non str keys that json rejects, write NaN
+    # and infinity as null, and only allows 64 bit ints and 255 levels of
+    # nesting, so all of those are left to the json module. a circular
+    # structure hits the depth limit, and the json module then reports it
+    t = type(value)
+    if t is str or t is bool or value is None:
+        return True
+    if t is int:
+        return -2 ** 63 <= value < 2 ** 64
+    if t is float:
+        return value - value == 0.0  # not NaN or an infinity
+    if depth >= 254:
+        return False
+    if t is list or t is tuple:
+        for item in value:
+            if not _is_plain_json(item, depth + 1):
+                return False
+        return True
+    if t is dict:
+        for k, item in value.items():
+            if type(k) is not str or not _is_plain_json(item, depth + 1):
+                return False
+        return True
+    return False
+
+
+def _keys_as_json(keys):
+    # the keys as a single json array for json_each, or None when that can't
+    # be used: sqlite's json functions cut text short at a NUL character
+    if not _SQLITE_SUPPORTS_JSON:
+        return None
+    try:
+        keys_json = _json.dumps(keys, default=_raise_key_type_error, allow_nan=False)
+    except ValueError:
+        # NaN, infinities or a circular structure, none of which are a str
+        for key in keys:
+            if type(key) is not str:
+                _raise_key_type_error(key)
+        raise
+    # json.dumps always escapes NUL, so this finds every key containing one
+    return None if '\\u0000' in keys_json else keys_json
 
 
-def _flatten(xss):
-        return [x for xs in xss for x in xs]
+def _raise_key_type_error(key):
+    raise TypeError('key must be a str, not %s' % type(key))
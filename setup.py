@@ -0,0 +1,23 @@
+# Copyright 2024 Joseph P McAnulty. All rights reserved.
+import os
+
+from setuptools import setup
+
+# happystore is pure python, but it can optionally be compiled with cython
+# (declarations live in happystore.pxd) by building with
+# HAPPYSTORE_ENABLE_SPEEDUPS=1 and cython installed. to check that build,
+# run the tests with HAPPYSTORE_TEST_SPEEDUPS=1, which builds the extension
+# in a temporary directory and runs the whole suite against it:
+#
+#   HAPPYSTORE_TEST_SPEEDUPS=1 python -m unittest discover -s tests
+#
+# everything else is configured in setup.cfg
+ext_modules = []
+if os.environ.get('HAPPYSTORE_ENABLE_SPEEDUPS') == '1':
+    from Cython.Build import cythonize
+    ext_modules = cythonize(
+        ['happystore.py'],
+        compiler_directives={'language_level': 3, 'binding': True}
+    )
+
+setup(ext_modules=ext_modules)
@@ -1,13 +1,122 @@
 # Copyright 2024 Joseph P McAnulty. All rights reserved.
+import dataclasses
+import datetime
+import enum
+import math
 import os
+import pickle
+import multiprocessing
+import multiprocessing.util
+import queue
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
 import threading
 import time
+import uuid
+import weakref
 import unittest
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from importlib.machinery import EXTENSION_SUFFIXES
+from unittest import mock
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, wait
 from functools import partial
+from itertools import islice
 
 import happystore
 
+
+# PickleSerializer holds no per-store state, so every store can share one
+_PICKLE = happystore.PickleSerializer()
+
+# expected query results over the keys a, ab and c
+_ABC = [('a', 1), ('ab', 2), ('c', 3)]
+_AB = [('a', 1), ('ab', 2)]
+_AB_C = [('ab', 2), ('c', 3)]
+_C = [('c', 3)]
+_REV_C_AB = [('c', 3), ('ab', 2)]
+_REV_AB = [('ab', 2), ('a', 1)]
+_EMPTY = []
+
+
+def remove_db_file(path):
+    # a WAL mode database may leave -wal and -shm files next to the main file
+    for p in (path, path + '-wal', path + '-shm'):
+        if os.path.exists(p):
+            os.remove(p)
+
+
+class IncrBatcher:
+    # coalesces increments of one key so that each batch costs a single transaction
+    max_batch_size = 64
+    max_batch_wait = 0.01
+
+    def __init__(self, store, key, max_batch_size=None):
+        self.store = store
+        self.key = key
+        if max_batch_size is not None:
+            self.max_batch_size = max_batch_size
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, n):
+        # the returned future resolves once the increment has been committed,
+        # or fails with whatever error its batch ran into
+        future = Future()
+        self._queue.put((n, future))
+        return future
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_batch_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._apply(batch)
+                    return
+                batch.append(item)
+            self._apply(batch)
+
+    def _apply(self, batch):
+        try:
+            with self.store.transaction():
+                self.store.set(self.key, self.store.get(self.key) + sum(n for n, _ in batch))
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+        else:
+            for _, future in batch:
+                future.set_result(None)
+
+
+class IntSerializer(happystore.Serializer):
+    # a cheap codec for tests that only ever store ints
+    def serialize(self, value):
+        try:
+            return struct.pack('<q', value)
+        except struct.error:
+            raise happystore.SerializationError('couldn\'t serialize value')
+
+    def deserialize(self, bytess):
+        try:
+            return struct.unpack('<q', bytess)[0]
+        except struct.error:
+            raise happystore.DeserializationError('couldn\'t deserialize value')
+
+
 class BasicInOutTestsMixin:
     def test_basic_in_out_scenario(self):
         self.store.set('a', 5)
@@ -36,7 +145,7 @@ class BasicInOutTestsMixin:
         res = self.store.bulk_get(['a', 'b', 'd'])
         self.assertEqual(res[0], 5)
         self.assertEqual(res[1], 7)
-        self.assertEqual(type(res[2]), LookupError)
+        self.assertIsInstance(res[2], LookupError)
 
         res = self.store.bulk_delete(['a', 'd'])
         self.assertEqual(res, [True, False])
@@ -44,145 +153,120 @@ class BasicInOutTestsMixin:
         res = self.store.has('a')
         self.assertEqual(res, False)
 
+    def test_bulk_delete_without_returning(self):
+        self.store.bulk_set([('a', 1), ('a\x00b', 2)])
+
+        with mock.patch.object(happystore, '_SQLITE_SUPPORTS_RETURNING', False):
+            res = self.store.bulk_delete(['a', 'a\x00b', 'd'])
+        self.assertEqual(res, [True, True, False])
+        self.assertEqual(self.store.has('a'), False)
+        self.assertEqual(self.store.has('a\x00b'), False)
+
+    def test_bulk_keys_containing_nul(self):
+        self.store.bulk_set([('a\x00b', 1), ('c', 2)])
+
+        res = self.store.bulk_get(['a\x00b', 'c', 'd'])
+        self.assertEqual(res[:2], [1, 2])
+        self.assertIsInstance(res[2], LookupError)
+
+        res = self.store.bulk_delete(['a\x00b', 'c', 'd'])
+        self.assertEqual(res, [True, True, False])
+        self.assertEqual(self.store.has('a\x00b'), False)
+
     def test_query_by_keyprefix(self):
-        self.store.set('a', 1)
-        self.store.set('ab', 2)
-        self.store.set('c', 3)
+        self.store.bulk_set(_ABC)
 
         res = self.store.query(keyprefix='a')
-        self.assertEqual(
-            res,
-            [('a', 1), ('ab', 2)]
-        )
+        self.assertListEqual(res, _AB)
 
         res = self.store.query(keyprefix='c')
-        self.assertEqual(
-            res,
-            [('c', 3)]
-        )
+        self.assertListEqual(res, _C)
 
         res = self.store.query(keyprefix='d')
-        self.assertEqual(
-            res,
-            []
-        )
+        self.assertListEqual(res, _EMPTY)
 
         res = self.store.query(keyprefix='ac')
-        self.assertEqual(
-            res,
-            []
-        )
+        self.assertListEqual(res, _EMPTY)
 
         res = self.store.query(keyprefix='')
-        self.assertEqual(
-            res,
-            [('a', 1), ('ab', 2), ('c', 3)]
-        )
+        self.assertListEqual(res, _ABC)
+
+        res = self.store.query(keyprefix='a', reverse=True)
+        self.assertListEqual(res, _REV_AB)
+
+        res = self.store.query(keyprefix='a', limit=1, reverse=True)
+        self.assertListEqual(res, _REV_AB[:1])
+
+        # any truthy value reverses, as it always has
+        res = self.store.query(keyprefix='a', reverse=[1])
+        self.assertListEqual(res, _REV_AB)
 
     def test_query_by_min_max_range(self):
-        self.store.set('a', 1)
-        self.store.set('ab', 2)
-        self.store.set('c', 3)
+        self.store.bulk_set(_ABC)
 
         res = self.store.query(start='a', end='ab')
-        self.assertEqual(
-            res,
-            [('a', 1), ('ab', 2)]
-        )
+        self.assertListEqual(res, _AB)
 
         res = self.store.query(start='c', end='c')
-        self.assertEqual(
-            res,
-            [('c', 3)]
-        )
+        self.assertListEqual(res, _C)
 
         res = self.store.query(start='d', end='e')
-        self.assertEqual(
-            res,
-            []
-        )
+        self.assertListEqual(res, _EMPTY)
 
         res = self.store.query(start='ab', end='c')
-        self.assertEqual(
-            res,
-            [('ab', 2), ('c', 3)]
-        )
+        self.assertListEqual(res, _AB_C)
 
         res = self.store.query(start='', end='z')
-        self.assertEqual(
-            res,
-            [('a', 1), ('ab', 2), ('c', 3)]
-        )
+        self.assertListEqual(res, _ABC)
 
     def test_query_by_min_and_limit(self):
-        self.store.set('a', 1)
-        self.store.set('ab', 2)
-        self.store.set('c', 3)
+        self.store.bulk_set(_ABC)
 
         res = self.store.query(start='a', limit=2)
-        self.assertEqual(
-            res,
-            [('a', 1), ('ab', 2)]
-        )
+        self.assertListEqual(res, _AB)
 
         res = self.store.query(start='a', limit=2, reverse=True)
-        self.assertEqual(
-            res,
-            [('c', 3), ('ab', 2)]
-        )
+        self.assertListEqual(res, _REV_C_AB)
 
         res = self.store.query(start='', limit=2)
-        self.assertEqual(
-            res,
-            [('a', 1), ('ab', 2)]
-        )
+        self.assertListEqual(res, _AB)
 
         res = self.store.query(start='d', limit=2, reverse=True)
-        self.assertEqual(
-            res,
-            []
-        )
+        self.assertListEqual(res, _EMPTY)
 
     def test_query_by_max_and_limit(self):
-        self.store.set('a', 1)
-        self.store.set('ab', 2)
-        self.store.set('c', 3)
+        self.store.bulk_set(_ABC)
 
         res = self.store.query(end='c', limit=2)
-        self.assertEqual(
-            res,
-            [('a', 1), ('ab', 2)]
-        )
+        self.assertListEqual(res, _AB)
 
         res = self.store.query(end='c', limit=2, reverse=True)
-        self.assertEqual(
-            res,
-            [('c', 3), ('ab', 2)]
-        )
+        self.assertListEqual(res, _REV_C_AB)
 
         res = self.store.query(end='e', limit=2)
-        self.assertEqual(
-            res,
-            [('a', 1), ('ab', 2)]
-        )
+        self.assertListEqual(res, _AB)
 
         res = self.store.query(end='e', limit=2, reverse=True)
-        self.assertEqual(
-            res,
-            [('c', 3), ('ab', 2)]
-        )
+        self.assertListEqual(res, _REV_C_AB)
 
     def test_scan(self):
-        self.store.set('a', 1)
-        self.store.set('b', 2)
-        self.store.set('c', 3)
+        self.store.bulk_set([('a', 1), ('b', 2), ('c', 3)])
 
-        res = list(self.store.scan(pagesize=1))
+        res = list(self.store.scan(pagesize=16))
         self.assertEqual(
             res,
             [('a', 1), ('b', 2), ('c', 3)]
         )
 
+        # a key count that is an exact multiple of pagesize, so the scan
+        # only finds the end on a last, empty page
+        for pagesize in (1, 3):
+            res = list(self.store.scan(pagesize=pagesize))
+            self.assertEqual(
+                res,
+                [('a', 1), ('b', 2), ('c', 3)]
+            )
+
     def test_transaction_commit(self):
         with self.store.transaction():
             self.store.set('a', 1)
@@ -218,10 +302,11 @@ class BasicInOutTestsMixin:
                     self.store.set('c', 3)
             self.store.set('d', 4)
 
-        self.assertEqual(self.store.has('a'), True)
-        self.assertEqual(self.store.has('b'), False)
-        self.assertEqual(self.store.has('c'), True)
-        self.assertEqual(self.store.has('d'), True)
+        res = self.store.bulk_get(['a', 'b', 'c', 'd'])
+        self.assertEqual(
+            [not isinstance(r, LookupError) for r in res],
+            [True, False, True, True]
+        )
 
         # set up a complex scenario with a bubbling up exception
         with self.assertRaises(Exception):
@@ -235,61 +320,180 @@ class BasicInOutTestsMixin:
                         self.store.set('g', 3)
                 self.store.set('h', 4)
 
-        self.assertEqual(self.store.has('e'), False)
-        self.assertEqual(self.store.has('f'), False)
-        self.assertEqual(self.store.has('g'), False)
-        self.assertEqual(self.store.has('h'), False)
+        res = self.store.bulk_get(['e', 'f', 'g', 'h'])
+        self.assertEqual(
+            [not isinstance(r, LookupError) for r in res],
+            [False, False, False, False]
+        )
 
 
 class InterfaceErrorTestsMixin:  # type errors, value errors, runtime errors, etc 
-    pass  # TODO write these eventually
+    def test_query_and_scan_bad_argument_types(self):
+        with self.assertRaisesRegex(TypeError, 'keyprefix must be a str'):
+            self.store.query(keyprefix=1)
+        with self.assertRaisesRegex(TypeError, 'start must be a str'):
+            self.store.query(start=b'a')
+        with self.assertRaisesRegex(TypeError, 'end must be a str'):
+            self.store.query(end=1)
+        with self.assertRaisesRegex(TypeError, 'pagesize must be int'):
+            self.store.scan(pagesize='1')
+        with self.assertRaisesRegex(TypeError, 'pagesize must be int'):
+            self.store.scan(pagesize=1.0)
+        with self.assertRaises(RuntimeError):
+            self.store.query(keyprefix='a', start='a')
+
+    def test_scan_bad_pagesize(self):
+        with self.assertRaisesRegex(ValueError, 'pagesize must be at least 1'):
+            self.store.scan(pagesize=0)
+        with self.assertRaisesRegex(ValueError, 'pagesize must be at least 1'):
+            self.store.scan(pagesize=-1)
+
+    def test_failed_bulk_set_rolls_back_only_its_batch(self):
+        with self.store.transaction():
+            self.store.set('a', 1)
+            with self.assertRaisesRegex(TypeError, 'key must be a str'):
+                self.store.bulk_set([('b', 2), (3, 3)])
+            with self.assertRaises(happystore.SerializationError):
+                self.store.bulk_set([('c', 3), ('d', threading.Lock())])
+            self.store.set('e', 5)
+
+        res = self.store.bulk_get(['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(
+            [not isinstance(r, LookupError) for r in res],
+            [True, False, False, False, True]
+        )
+
+    def test_abort_after_a_caught_bulk_set_failure(self):
+        # the failed bulk_set's savepoint mustn't be left behind, or the
+        # abort below would only roll back to it
+        with self.store.transaction():
+            with self.store.transaction():
+                self.store.set('x', 1)
+                with self.assertRaises(TypeError):
+                    self.store.bulk_set([('b', 2), (3, 3)])
+                raise happystore.AbortionError()
+            self.store.set('y', 2)
+
+        res = self.store.bulk_get(['x', 'b', 'y'])
+        self.assertEqual(
+            [not isinstance(r, LookupError) for r in res],
+            [False, False, True]
+        )
+
+        with self.store.transaction():
+            with self.store.transaction():
+                with self.store.transaction():
+                    self.store.set('z', 3)
+                    raise happystore.AbortionError()
+                self.store.set('w', 4)
+                raise happystore.AbortionError()
+
+        res = self.store.bulk_get(['z', 'w'])
+        self.assertEqual(
+            [not isinstance(r, LookupError) for r in res],
+            [False, False]
+        )
+
+    def test_failed_bulk_delete_rolls_back_only_its_batch(self):
+        self.store.bulk_set([('a', 1), ('b', 2), ('c', 3)])
+
+        with self.store.transaction():
+            self.store.delete('a')
+            with self.assertRaisesRegex(TypeError, 'key must be a str'):
+                self.store.bulk_delete(['b', 3])
+            self.store.delete('c')
+
+        res = self.store.bulk_get(['a', 'b', 'c'])
+        self.assertEqual(
+            [not isinstance(r, LookupError) for r in res],
+            [False, True, False]
+        )
+
+    def test_bulk_get_bad_key_type(self):
+        with self.assertRaisesRegex(TypeError, 'key must be a str'):
+            self.store.bulk_get(['a', b'b'])
+        with self.assertRaisesRegex(TypeError, 'key must be a str'):
+            self.store.bulk_get(['a', 1])
+        for key in (float('nan'), float('inf')):
+            with self.assertRaisesRegex(TypeError, 'key must be a str'):
+                self.store.bulk_get(['a', key])
+
+    def test_bulk_delete_bad_key_type(self):
+        self.store.set('a', 1)
+
+        with self.assertRaisesRegex(TypeError, 'key must be a str'):
+            self.store.bulk_delete(['a', b'b'])
+        with self.assertRaisesRegex(TypeError, 'key must be a str'):
+            self.store.bulk_delete(['a', 1])
+        for key in (float('nan'), float('-inf')):
+            with self.assertRaisesRegex(TypeError, 'key must be a str'):
+                self.store.bulk_delete(['a', key])
+        # nothing was deleted
+        self.assertEqual(self.store.has('a'), True)
 
 
 class StressTestsMixin:
     def test_1000_threads_incrementing_one_key(self):
         self.store.set('a', 0)
+        batcher = IncrBatcher(self.store, 'a')
+        self.addCleanup(batcher.close)
 
         def incr_a():
-            time.sleep(1)
-            with self.store.transaction():
-                a_val = self.store.get('a')
-                self.store.set('a', a_val + 1)
-
-        for i in range(1000):
-            t = threading.Thread(target=incr_a)
-            t.start()
+            batcher.submit(1).result(timeout=10)
 
-        time.sleep(2)  # give the 1000 threads a clear head start
+        futures = [self.thread_executor.submit(incr_a) for _ in range(1000)]
+        wait(futures)
+        for future in futures:
+            future.result()
         self.assertEqual(self.store.get('a'), 1000)
 
     def test_1000_threads_inserting_their_own_key(self):
-        for i in range(1000):
-            t = threading.Thread(target=self.store.set, args=(str(i), i))
-            t.start()
-        time.sleep(1)  # give the 1000 threads a head start
+        list(self.thread_executor.map(self.store.set, map(str, range(1000)), range(1000)))
         self.assertEqual(self.store.get('0'), 0)
         self.assertEqual(self.store.get('999'), 999)
 
     def test_scan_1000_keys(self):
-        for i in range(1000):
-            self.store.set(str(i), i)
+        self.store.bulk_set([(str(i), i) for i in range(1000)])
 
-        self.assertEqual(len(list(self.store.scan(pagesize=1))), 1000)
+        self.assertEqual(sum(1 for _ in self.store.scan(pagesize=256)), 1000)
+        # 1000 is a multiple of 250, so this ends on an empty page
+        self.assertEqual(
+            [k for k, _ in self.store.scan(pagesize=250)],
+            sorted(str(i) for i in range(1000))
+        )
+        # still walk the one row per page path, but only over the first few keys
+        self.assertEqual(
+            [k for k, _ in islice(self.store.scan(pagesize=1), 10)],
+            sorted(str(i) for i in range(1000))[:10]
+        )
 
     def test_long_running_transaction_contention(self):
         self.store.set('a', 0)
+        entered = threading.Event()
+        release = threading.Event()
 
-        def incr_a():
+        def long_incr_a():
             with self.store.transaction():
                 a_val = self.store.get('a')
-                time.sleep(7)
+                entered.set()
+                # hold the transaction open until the other side tries to get in
+                release.wait(timeout=5)
                 self.store.set('a', a_val + 1)
 
-        for i in range(2):
-            t = threading.Thread(target=incr_a)
-            t.start()
+        def contending_incr_a():
+            entered.wait(timeout=5)
+            release.set()
+            with self.store.transaction():
+                a_val = self.store.get('a')
+                self.store.set('a', a_val + 1)
 
-        time.sleep(1)  # make sure the transactions above get a change to 'start'
+        futures = [
+            self.thread_executor.submit(long_incr_a),
+            self.thread_executor.submit(contending_incr_a)
+        ]
+        wait(futures)
+        for future in futures:
+            future.result()
         self.assertEqual(self.store.get('a'), 2)
 
 
@@ -298,13 +502,35 @@ class BaiscInOutTestsInMemory(
     BasicInOutTestsMixin,
     InterfaceErrorTestsMixin,
     StressTestsMixin
+):
+    @classmethod
+    def setUpClass(cls):
+        # one store for the whole class, emptied between tests
+        cls.store = happystore.HappyStore(
+            ':memory:',
+            serializer=_PICKLE
+        )
+        cls.addClassCleanup(cls.store.close)
+
+    def setUp(self):
+        with self.store.transaction():
+            self.store.bulk_delete([k for k, _ in self.store.query(start='')])
+        self.thread_executor = ThreadPoolExecutor(max_workers=32)
+        self.addCleanup(self.thread_executor.shutdown)
+
+
+class StressTestsInMemoryFast(
+    unittest.TestCase,
+    StressTestsMixin
 ):
     def setUp(self):
         self.store = happystore.HappyStore(
             ':memory:',
-            serializer=happystore.PickleSerializer()
+            serializer=IntSerializer()
         )
         self.addCleanup(self.store.close)
+        self.thread_executor = ThreadPoolExecutor(max_workers=32)
+        self.addCleanup(self.thread_executor.shutdown)
 
 
 class BaiscInOutTestsOnDisk(
@@ -313,42 +539,150 @@ class BaiscInOutTestsOnDisk(
     InterfaceErrorTestsMixin,
     StressTestsMixin
 ):
-    def setUp(self):
-        # make the store
-        self.store = happystore.HappyStore(
+    @classmethod
+    def setUpClass(cls):
+        # open the file once for the whole class, and empty it between tests
+        cls.store = happystore.HappyStore(
             'test_db.dat',
-            serializer=happystore.PickleSerializer()
+            serializer=_PICKLE
         )
-        self.addCleanup(partial(os.remove, 'test_db.dat'))
-        self.addCleanup(self.store.close)
+        cls.addClassCleanup(partial(remove_db_file, 'test_db.dat'))
+        cls.addClassCleanup(cls.store.close)
+
+    def setUp(self):
+        with self.store.transaction():
+            self.store.bulk_delete([k for k, _ in self.store.query(start='')])
+        self.thread_executor = ThreadPoolExecutor(max_workers=32)
+        self.addCleanup(self.thread_executor.shutdown)
+
+
+class Color(enum.Enum):
+    RED = 1
+
+
+class Level(enum.IntEnum):
+    HIGH = 2
+
+
+@dataclasses.dataclass
+class Point:
+    x: int
+    y: int
+
+
+class SerializerTests(unittest.TestCase):
+    def test_json_round_trip(self):
+        serializer = happystore.JsonSerializer()
+        for value in ({'a': [1, 2.5, None, True]}, 'b', 2 ** 70):
+            self.assertEqual(serializer.deserialize(serializer.serialize(value)), value)
+
+    def test_json_round_trip_without_orjson(self):
+        serializer = happystore.JsonSerializer()
+        with mock.patch.object(happystore, '_orjson', None):
+            self.assertEqual(serializer.deserialize(serializer.serialize({'a': [1]})), {'a': [1]})
+
+    def test_json_errors(self):
+        serializer = happystore.JsonSerializer()
+        with self.assertRaises(happystore.SerializationError):
+            serializer.serialize(object())
+        with self.assertRaises(happystore.DeserializationError):
+            serializer.deserialize(b'not json')
+
+    def test_json_same_with_and_without_orjson(self):
+        serializer = happystore.JsonSerializer()
+        circular = []
+        circular.append(circular)
+        unserializable = (
+            datetime.date(2024, 1, 1),
+            uuid.UUID(int=1),
+            Color.RED,
+            Point(1, 2),
+            {datetime.date(2024, 1, 1): 1},
+            circular
+        )
+        for orjson in (happystore._orjson, None):
+            with self.subTest(orjson=orjson), mock.patch.object(happystore, '_orjson', orjson):
+                for value in unserializable:
+                    with self.assertRaises(happystore.SerializationError):
+                        serializer.serialize(value)
+
+                self.assertEqual(serializer.deserialize(serializer.serialize({1: 'a'})), {'1': 'a'})
+                self.assertEqual(serializer.deserialize(serializer.serialize(Level.HIGH)), 2)
+                self.assertTrue(math.isnan(serializer.deserialize(serializer.serialize(float('nan')))))
+                for value in (2 ** 70 + 1, -2 ** 63 - 1, 10 ** 30, [2 ** 64 - 1, -2 ** 63]):
+                    self.assertEqual(serializer.deserialize(serializer.serialize(value)), value)
+                # as written by the json module, before orjson was installed
+                self.assertEqual(serializer.deserialize(b'[1180591620717411303425]'), [2 ** 70 + 1])
+
+    def test_pickle_protocol(self):
+        class Protocol2Pickler(pickle.Pickler):
+            def __init__(self, f):
+                super().__init__(f, protocol=2)
+
+        # protocol 2 and up start with the PROTO opcode and the protocol number
+        for serializer, protocol in (
+            (happystore.PickleSerializer(), pickle.HIGHEST_PROTOCOL),
+            (happystore.PickleSerializer(protocol=3), 3),
+            (happystore.PickleSerializer(pickler_factory=Protocol2Pickler), 2),
+            (happystore.PickleSerializer(pickler_factory=partial(pickle.Pickler, protocol=2)), 2),
+            (happystore.PickleSerializer(pickler_factory=pickle._Pickler, protocol=4), 4),
+        ):
+            with self.subTest(serializer=serializer.pickler_factory, protocol=protocol):
+                bytess = serializer.serialize({'a': [1]})
+                self.assertEqual(bytess[:2], bytes([pickle.PROTO[0], protocol]))
+                self.assertEqual(serializer.deserialize(bytess), {'a': [1]})
+
+    def test_weakly_referenceable(self):
+        store = happystore.HappyStore(':memory:', serializer=_PICKLE)
+        self.addCleanup(store.close)
+        for obj in (
+            store,
+            happystore.PickleSerializer(),
+            happystore.JsonSerializer(),
+            happystore.RawSerializer()
+        ):
+            self.assertIs(weakref.ref(obj)(), obj)
+
+    def test_raw_round_trip(self):
+        serializer = happystore.RawSerializer()
+        self.assertEqual(serializer.deserialize(serializer.serialize(b'abc')), b'abc')
+        with self.assertRaises(happystore.SerializationError):
+            serializer.serialize('abc')
+        with self.assertRaises(happystore.DeserializationError):
+            serializer.deserialize('abc')
 
 
 class SerializationAnomaliesThreadingTests(unittest.TestCase):  # ensure multi-threading is actually safe
+    @classmethod
+    def setUpClass(cls):
+        # the store api blocks, so the two sides of each test need real
+        # threads; the same two are reused by every test in the class
+        cls.thread_executor = ThreadPoolExecutor(max_workers=2)
+        cls.addClassCleanup(cls.thread_executor.shutdown)
+
     def setUp(self):
         # first, i need a store object to use
-        self.store = happystore.HappyStore(':memory:', serializer=happystore.PickleSerializer())
-        # then, i need to share it between two threads
-        self.thread_executor = ThreadPoolExecutor(max_workers=2)
-        self.addCleanup(self.thread_executor.shutdown)
+        self.store = happystore.HappyStore(':memory:', serializer=_PICKLE)
+        self.addCleanup(self.store.close)
+        # transactions hold the store's lock, so the barrier is always
+        # crossed inside the first transaction and before the second one
+        self.barrier = threading.Barrier(2, timeout=5)
 
     def test_no_dirty_reads_with_transactions(self):
         # create ideal conditions for dirty read
         def fast_reader():
             with self.store.transaction():
-                # try to read a somewhat quickly,
-                # but it shouldn't be here yet
-                # since it wasn't commited
-                # by slow_writer
-                time.sleep(1)
+                # slow_writer is now trying to write, but
+                # 'a' shouldn't be here yet since
+                # it couldn't have been commited
+                self.barrier.wait()
                 result = self.store.has('a')
                 return result
 
         def slow_writer():
+            self.barrier.wait()
             with self.store.transaction():
-                # quickly set a value
                 self.store.set('a', 1)
-                # but wait a bit to 'commit'
-                time.sleep(2)
 
         
         fast_reader_future = self.thread_executor.submit(fast_reader)
@@ -367,13 +701,13 @@ class SerializationAnomaliesThreadingTests(unittest.TestCase):  # ensure multi-t
         # create ideal conditions for non-repeatable read
         def slow_reader():
             with self.store.transaction():
-                time.sleep(2)
+                self.barrier.wait()
                 result = self.store.has('a')
                 return result
 
         def fast_writer():
+            self.barrier.wait()
             with self.store.transaction():
-                time.sleep(1)
                 self.store.set('a', 1)
         
         slow_reader_future = self.thread_executor.submit(slow_reader)
@@ -396,9 +730,10 @@ class SerializationAnomaliesThreadingTests(unittest.TestCase):  # ensure multi-t
             with self.store.transaction():
                 val = self.store.get('a')
                 self.store.set('a', val + 1)
-                time.sleep(2)
+                self.barrier.wait()
 
         def fast_incr():
+            self.barrier.wait()
             with self.store.transaction():
                 val = self.store.get('a')
                 self.store.set('a', val + 1)
@@ -413,8 +748,7 @@ class SerializationAnomaliesThreadingTests(unittest.TestCase):  # ensure multi-t
         self.assertEqual(self.store.get('a'), 3)
 
     def test_no_write_skew_with_transactions(self):
-        self.store.set('a', 1)
-        self.store.set('b', 1)
+        self.store.bulk_set([('a', 1), ('b', 1)])
 
         # race to delete either a or b, but make
         # sure at least a or b exists at end
@@ -422,19 +756,22 @@ class SerializationAnomaliesThreadingTests(unittest.TestCase):  # ensure multi-t
         def x():
             with self.store.transaction():
                 if self.store.has('b'):
-                    time.sleep(1)  # without serilization, y changes the condition
+                    # without serilization, y changes the condition
+                    self.barrier.wait()
                     self.store.delete('a')
 
         def y():
+            self.barrier.wait()
             with self.store.transaction():
                 if self.store.has('a'):
-                    time.sleep(1)  # without serilization, x changes the condition
                     self.store.delete('b')
         
         x_future = self.thread_executor.submit(x)
         y_future = self.thread_executor.submit(y)
 
-        wait([slow_incr_future, fast_incr_future])
+        wait([x_future, y_future])
+        x_future.result()
+        y_future.result()
 
         # if we don't allow write skew, then either a or b should
         # exist. write skew would cause them to both not exist
@@ -446,14 +783,24 @@ class SerializationAnomaliesThreadingTests(unittest.TestCase):  # ensure multi-t
 
 class SerializationAnomaliesMultiProcessingTests(unittest.TestCase):
     def setUp(self):
-        self.store = happystore.HappyStore(
-            'test_db.dat',
-            serializer=happystore.PickleSerializer()
+        # the workers open (and so create) the store themselves
+        self.addCleanup(partial(remove_db_file, 'test_db.dat'))
+        # spawn so workers don't inherit the parent's open connection
+        mp_context = multiprocessing.get_context('spawn')
+        self.proc_executor = ProcessPoolExecutor(
+            max_workers=2,
+            mp_context=mp_context,
+            initializer=_init_worker,
+            initargs=('test_db.dat', mp_context.Barrier(2, timeout=10))
         )
-        self.addCleanup(partial(os.remove, 'test_db.dat'))
-        # then, i need to share it between two processes
-        self.proc_executor = ProcessPoolExecutor(max_workers=2)
         self.addCleanup(self.proc_executor.shutdown)
+        # start both workers before the test body, and only return once
+        # both have opened their store
+        wait([self.proc_executor.submit(_warm_up) for _ in range(2)])
+
+    def _open(self):
+        # a short lived store in this process, for seeding and reading back
+        return happystore.HappyStore('test_db.dat', serializer=_PICKLE)
 
     def test_no_dirty_reads_with_transactions(self):
         # create ideal conditions for dirty read
@@ -468,7 +815,8 @@ class SerializationAnomaliesMultiProcessingTests(unittest.TestCase):
         # it wasn't commited yet
         self.assertEqual(fast_reader_future.result(), False)
         # but now our new get should see the new value
-        self.assertEqual(self.store.get('a'), 1)
+        with self._open() as store:
+            self.assertEqual(store.get('a'), 1)
 
     def test_no_non_repeatable_reads_with_transactions(self):
         # create ideal conditions for non-repeatable read
@@ -483,11 +831,13 @@ class SerializationAnomaliesMultiProcessingTests(unittest.TestCase):
         # it was started (snapshot isolation property)
         self.assertEqual(slow_reader_future.result(), False)
         # but now our new get should see the new value
-        self.assertEqual(self.store.get('a'), 1)
+        with self._open() as store:
+            self.assertEqual(store.get('a'), 1)
 
     def test_no_lost_updates_with_transactions(self):
         # create ideal conditions for lost update
-        self.store.set('a', 1)
+        with self._open() as store:
+            store.set('a', 1)
         
         slow_incr_future = self.proc_executor.submit(slow_incr)
         fast_incr_future = self.proc_executor.submit(fast_incr)
@@ -496,74 +846,97 @@ class SerializationAnomaliesMultiProcessingTests(unittest.TestCase):
 
         # 'a' should be three if the transactions are truly
         # serialized. a 'lost update would make it only 2
-        self.assertEqual(self.store.get('a'), 3)
+        with self._open() as store:
+            self.assertEqual(store.get('a'), 3)
+
+
+@unittest.skipUnless(
+    os.environ.get('HAPPYSTORE_TEST_SPEEDUPS') == '1',
+    'set HAPPYSTORE_TEST_SPEEDUPS=1 (needs cython and a c compiler) to '
+    'build the optional extension and run this suite against it'
+)
+class CompiledBuildTests(unittest.TestCase):
+    # smoke test for the HAPPYSTORE_ENABLE_SPEEDUPS build in setup.py
+    def test_suite_passes_against_compiled_build(self):
+        repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        tests_dir = os.path.join(repo_dir, 'tests')
+        with tempfile.TemporaryDirectory() as build_dir:
+            for name in ('setup.py', 'setup.cfg', 'README.md', 'happystore.py', 'happystore.pxd'):
+                shutil.copy(os.path.join(repo_dir, name), build_dir)
+            env = dict(os.environ, HAPPYSTORE_ENABLE_SPEEDUPS='1')
+            del env['HAPPYSTORE_TEST_SPEEDUPS']  # don't recurse
+            subprocess.run(
+                [sys.executable, 'setup.py', 'build_ext', '--inplace'],
+                cwd=build_dir, env=env, check=True, capture_output=True
+            )
+            # from build_dir the compiled module shadows the copied source
+            subprocess.run(
+                [
+                    sys.executable, '-c',
+                    'import happystore; assert happystore.__file__.endswith(%r)'
+                    % (tuple(EXTENSION_SUFFIXES),)
+                ],
+                cwd=build_dir, env=env, check=True
+            )
+            result = subprocess.run(
+                [sys.executable, '-m', 'unittest', 'discover', '-s', tests_dir, '-t', tests_dir],
+                cwd=build_dir, env=env, capture_output=True, text=True
+            )
+            self.assertEqual(result.returncode, 0, result.stderr)
+
+
+_STORE = None
+_BARRIER = None
+
+
+def _init_worker(path, barrier):
+    # open one store per worker process rather than one per task
+    global _STORE, _BARRIER
+    _STORE = happystore.HappyStore(path, serializer=_PICKLE)
+    # unlike atexit handlers, multiprocessing finalizers run on the way
+    # out of a worker whatever the start method
+    multiprocessing.util.Finalize(None, _STORE.close, exitpriority=0)
+    # as in the threading tests, the barrier is crossed inside the
+    # first transaction and before the second one begins
+    _BARRIER = barrier
+
+
+def _warm_up():
+    # both warmup tasks have to be running at once to get past this
+    _BARRIER.wait()
 
 
 def slow_incr():
-    store = happystore.HappyStore(
-        'test_db.dat',
-        serializer=happystore.PickleSerializer()
-    )
-    with store.transaction():
-        val = store.get('a')
-        store.set('a', val + 1)
-        time.sleep(2)
-    store.close()
+    with _STORE.transaction():
+        val = _STORE.get('a')
+        _STORE.set('a', val + 1)
+        _BARRIER.wait()
 
 def fast_incr():
-    store = happystore.HappyStore(
-        'test_db.dat',
-        serializer=happystore.PickleSerializer()
-    )
-    with store.transaction():
-        val = store.get('a')
-        store.set('a', val + 1)
-    store.close()
+    _BARRIER.wait()
+    with _STORE.transaction():
+        val = _STORE.get('a')
+        _STORE.set('a', val + 1)
 
 def slow_reader():
-    store = happystore.HappyStore(
-        'test_db.dat',
-        serializer=happystore.PickleSerializer()
-    )
-    with store.transaction():
-        time.sleep(2)
-        result = store.has('a')
-        return result
-    store.close()
+    with _STORE.transaction():
+        _BARRIER.wait()
+        return _STORE.has('a')
 
 def fast_writer():
-    store = happystore.HappyStore(
-        'test_db.dat',
-        serializer=happystore.PickleSerializer()
-    )
-    with store.transaction():
-        time.sleep(1)
-        store.set('a', 1)
-    store.close()
+    _BARRIER.wait()
+    with _STORE.transaction():
+        _STORE.set('a', 1)
 
 def fast_reader():
-    store = happystore.HappyStore(
-        'test_db.dat',
-        serializer=happystore.PickleSerializer()
-    )
-    with store.transaction():
-        # try to read a somewhat quickly,
-        # but it shouldn't be here yet
-        # since it wasn't commited
-        # by slow_writer
-        time.sleep(1)
-        result = store.has('a')
-        return result
-    store.close()
+    with _STORE.transaction():
+        # slow_writer is now trying to write, but
+        # 'a' shouldn't be here yet since
+        # it couldn't have been commited
+        _BARRIER.wait()
+        return _STORE.has('a')
 
 def slow_writer():
-    store = happystore.HappyStore(
-        'test_db.dat',
-        serializer=happystore.PickleSerializer()
-    )
-    with store.transaction():
-        # quickly set a value
-        store.set('a', 1)
-        # but wait a bit to 'commit'
-        time.sleep(2)
-    store.close()
+    _BARRIER.wait()
+    with _STORE.transaction():
+        _STORE.set('a', 1)